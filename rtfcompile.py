@@ -1,13 +1,19 @@
-import tempfile
 import argparse
+import asyncio
+import contextlib
+import functools
+import hashlib
+import mmap
+import os
 import re
+import shlex
 import shutil
 import subprocess
 from pathlib import Path
 
 import tomllib
 
-with open("header.tex", "r") as f:
+with open("header.tex", "rb") as f:
     HEADER = f.read()
 
 
@@ -22,176 +28,462 @@ def check_pandoc():
         raise Exception("Pandoc is not installed")
 
 
+def starts_with_two_digits(file_name):
+    """True if the name starts with two digits, ignoring dots (e.g. `11file.tex` or `1.1.file.tex`)"""
+    digits = 0
+    for char in file_name:
+        if char == ".":
+            continue
+        if not char.isdecimal():
+            return False
+        digits += 1
+        if digits == 2:
+            return True
+    return False
+
+
 def validate_files(file_paths: Path):
     for file_path in file_paths:
         file_name = file_path.name
-        if not re.match(r"\d{2}", file_name.replace(".", "")):
+        if not starts_with_two_digits(file_name):
             print(f"Warning: {file_name} does not start with a two-digit number")
 
 
-def sort_files(file_paths):
-    return sorted(file_paths, key=lambda x: x.name)
+def sorted_files_in(input_dir):
+    """Lists the files in `input_dir` sorted by name; directories are skipped"""
+    with os.scandir(input_dir) as entries:
+        # `is_file` uses the file type already returned by `scandir`, without a `stat`
+        names = sorted(entry.name for entry in entries if entry.is_file())
+    return [input_dir / name for name in names]
 
 
-def find_string(content, string):
+def find_strings(content, string):
+    """Returns the spans of the RTF groups containing each occurrence of `string`, in order"""
+    occurrences = []
+    # the template is scanned with a moving cursor, so each part is searched only once
+    cursor = 0
     start_index = content.find(string)
-    if start_index != -1:
-        start_brace = content.rfind("{", 0, start_index)
-        end_brace = content.find("}", start_index)
-        if start_brace != -1 and end_brace != -1:
-            return start_brace, end_brace + 1
-    return None
+    while start_index != -1:
+        start_brace = content.rfind(b"{", cursor, start_index)
+        end_brace = content.find(b"}", start_index)
+        if start_brace == -1 or end_brace == -1:
+            break
+        occurrences.append((start_brace, end_brace + 1))
+        cursor = end_brace + 1
+        start_index = content.find(string, cursor)
+    return occurrences
+
+
+# pandoc input formats for known file extensions; other files are left to pandoc
+INPUT_FORMATS = {
+    ".tex": "latex",
+    ".latex": "latex",
+    ".md": "markdown",
+    ".markdown": "markdown",
+    ".rtf": "rtf",
+}
+
 
+async def gather_limited(coroutines, limit=os.cpu_count() or 1):
+    """Like `asyncio.gather`, but runs at most `limit` coroutines at the same time"""
+    semaphore = asyncio.Semaphore(limit)
 
-def convert(
+    async def run(coroutine):
+        async with semaphore:
+            return await coroutine
+
+    return await asyncio.gather(*(run(coroutine) for coroutine in coroutines))
+
+
+@functools.cache
+def resources_digest(resource_paths):
+    """
+    Hashes the size and modification time of all the files in the `resource_paths`
+    directories (separated by `:`); the directories are walked only once per run
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    if resource_paths is None:
+        return digest.digest()
+    for resource_dir in resource_paths.split(":"):
+        for root, dir_names, file_names in os.walk(resource_dir):
+            dir_names.sort()
+            for file_name in sorted(file_names):
+                file_path = Path(root) / file_name
+                try:
+                    stat = file_path.stat()
+                except OSError:
+                    # e.g. a dangling symlink, which pandoc cannot read anyway
+                    continue
+                digest.update(
+                    f"{file_path}:{stat.st_size}:{stat.st_mtime_ns}\0".encode()
+                )
+    return digest.digest()
+
+
+@functools.cache
+def read_csl(csl_path):
+    """Reads the citation style once per run, however many files are converted"""
+    return Path(csl_path).read_bytes()
+
+
+@functools.cache
+def pandoc_version():
+    """
+    Returns the output of `pandoc --version`; it is first called by `main` before any
+    task starts, so the event loop is never blocked waiting for it
+    """
+    result = subprocess.run(["pandoc", "--version"], stdout=subprocess.PIPE, check=True)
+    return result.stdout
+
+
+def cache_key(command, source, input, csl_path, resource_paths):
+    """
+    Hashes everything that affects the output of pandoc: the pandoc version, the
+    command, the input, the citation style and the files in the resource paths (by size
+    and modification time)
+    """
+    key = hashlib.blake2b(pandoc_version(), digest_size=16)
+    for arg in command:
+        key.update(arg.encode() + b"\0")
+    key.update(Path(source).read_bytes() if input is None else input)
+    key.update(read_csl(csl_path))
+    key.update(resources_digest(resource_paths))
+    return key.hexdigest()
+
+
+async def run_pandoc(
+    source,
+    output_type,
+    input_format,
+    csl_path,
+    resource_paths,
+    suppress_bibliography,
+    input=None,
+    cache_dir=None,
+    out_path=None,
+):
+    """
+    Runs pandoc on `source`, which is `-` when the content is passed as `input`
+    If `cache_dir` is set, outputs are cached there and pandoc runs only for new inputs
+    If `out_path` is set, the output is written there and None is returned
+    """
+    if csl_path is None:
+        raise ValueError("citation_style must be provided in the config")
+    command = [
+        "pandoc",
+        str(source),
+        "--citeproc",
+        f"--csl={csl_path}",
+        f"--to={output_type}",
+        f"--metadata=suppress-bibliography:{suppress_bibliography}",
+    ]
+    if input_format is not None:
+        command.append(f"--from={input_format}")
+    if resource_paths is not None:
+        resource_path = ".:" + resource_paths
+        command.append(f"--resource-path={resource_path}")
+    if cache_dir is not None:
+        cache_path = Path(cache_dir) / cache_key(
+            command, source, input, csl_path, resource_paths
+        )
+        if cache_path.exists():
+            print("Using cached pandoc output for: " + shlex.join(command))
+            if out_path is not None:
+                shutil.copyfile(cache_path, out_path)
+                return None
+            return cache_path.read_bytes()
+    print("Running pandoc: " + shlex.join(command))
+    if out_path is None:
+        stdout = asyncio.subprocess.PIPE
+    else:
+        # pandoc writes straight to the output file, without passing through Python
+        stdout = open(out_path, "wb")
+    try:
+        process = await asyncio.create_subprocess_exec(
+            *command,
+            stdin=None if input is None else asyncio.subprocess.PIPE,
+            stdout=stdout,
+        )
+    finally:
+        if out_path is not None:
+            stdout.close()
+
+    # `communicate` writes the input and reads the output at the same time, so pandoc
+    # never blocks on a full pipe
+    converted_content, _ = await process.communicate(input)
+    if cache_dir is not None and process.returncode == 0:
+        cache_path.parent.mkdir(exist_ok=True, parents=True)
+        # written under a temporary name first, so an interrupted write never leaves a
+        # truncated output in the cache
+        partial_path = cache_path.with_name(f"{cache_path.name}.{os.getpid()}.partial")
+        if out_path is None:
+            partial_path.write_bytes(converted_content)
+        else:
+            shutil.copyfile(out_path, partial_path)
+        os.replace(partial_path, cache_path)
+    return converted_content
+
+
+async def convert_latex(
+    content,
+    output_type,
+    csl_path=None,
+    resource_paths=None,
+    suppress_bibliography=False,
+    footnote_size=10,
+    cache_dir=None,
+):
+    # add header.tex before of it; the content is piped to pandoc, so no temporary
+    # file is needed
+    content = HEADER + b"\n" + content
+    converted_content = await run_pandoc(
+        "-",
+        output_type,
+        "latex",
+        csl_path,
+        resource_paths,
+        suppress_bibliography,
+        input=content,
+        cache_dir=cache_dir,
+    )
+    if output_type == "rtf":
+        converted_content = fix_footnotes(converted_content, footnote_size)
+    return converted_content
+
+
+async def convert(
     file_path,
     output_type,
     csl_path=None,
     resource_paths=None,
     suppress_bibliography=False,
     footnote_size=10,
+    cache_dir=None,
 ):
-    if csl_path is None:
-        raise ValueError("citation_style must be provided in the config")
-    with open(file_path, "r") as file:
-        content = file.read()
-    if file_path.suffix == ".tex":
-        # add header.tex before of it
-        content = str(HEADER) + "\n" + str(content)
-
-    with tempfile.NamedTemporaryFile(delete=False, suffix=file_path.suffix) as file:
-        # copying to a temporary file so we can write a modified file
-        file.write(content.encode())
-        file.flush()
-        command = [
-            "pandoc",
-            file.name,
-            "--citeproc",
-            f"--csl={csl_path}",
-            f"--to={output_type}",
-            f"--metadata=suppress-bibliography:{suppress_bibliography}",
-        ]
-        if resource_paths is not None:
-            resource_path = ".:" + resource_paths
-            command.append(f"--resource-path={resource_path}")
-        command = [str(x) for x in command]
-        print("Running pandoc: " + " ".join(command))
-        result = subprocess.run(command, stdout=subprocess.PIPE)
-
-    converted_content = result.stdout.decode()
-    if file_path.suffix == ".tex":
+    input_format = INPUT_FORMATS.get(file_path.suffix)
+    if input_format == "latex":
+        return await convert_latex(
+            file_path.read_bytes(),
+            output_type,
+            csl_path,
+            resource_paths,
+            suppress_bibliography,
+            footnote_size,
+            cache_dir,
+        )
+    converted_content = await run_pandoc(
+        file_path,
+        output_type,
+        input_format,
+        csl_path,
+        resource_paths,
+        suppress_bibliography,
+        cache_dir=cache_dir,
+    )
+    if output_type == "rtf":
+        # pandoc writes footnotes from other formats, such as Markdown, in the same way
         converted_content = fix_footnotes(converted_content, footnote_size)
     return converted_content
 
 
-def prepend_append_rtf(rtf_content, file_name):
-    prepend = "{\\comment tex2rtf/from: " + file_name + "}\n"
-    append = "\n{\\comment tex2rtf/to: " + file_name + "}"
-    return prepend + rtf_content + append
+def rtf_markers(file_name):
+    """Returns the RTF comments to put before and after the content of a file"""
+    prepend = b"{\\comment tex2rtf/from: " + file_name.encode() + b"}\n"
+    append = b"\n{\\comment tex2rtf/to: " + file_name.encode() + b"}"
+    return prepend, append
 
 
-def extract_rtf_content(file_path):
-    with open(file_path, "r") as file:
-        content = file.read()
-    matches = re.findall(
-        r"{\\comment tex2rtf/from: (.*?)}(.*?){\\comment tex2rtf/to: \1}",
-        content,
-        re.DOTALL,
-    )
-    return [(match[0], match[1].strip()) for match in matches]
+WHITESPACES = b" \t\n\r\x0b\x0c"
+
+
+@contextlib.contextmanager
+def map_file(file_path):
+    """Memory-maps `file_path` for reading; empty files cannot be memory-mapped, so they give `b""`"""
+    with open(file_path, "rb") as file:
+        if os.fstat(file.fileno()).st_size == 0:
+            yield b""
+            return
+        with mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ) as content:
+            yield content
 
 
-FOOTNOTE_PATTERN = re.compile(r"\\footnote")
+def extract_rtf_content(file_path):
+    """Yields the name and the content, without surrounding whitespaces, of each region"""
+    # the file is memory-mapped, so only the regions are copied in memory
+    with map_file(file_path) as content:
+        yield from find_regions(content)
+
+
+def find_regions(content):
+    """Yields the name and the content, without surrounding whitespaces, of each region"""
+    # regions are located with plain `bytes.find` calls, which scan the content once
+    from_marker = b"{\\comment tex2rtf/from: "
+    region_start = content.find(from_marker)
+    while region_start != -1:
+        name_start = region_start + len(from_marker)
+        name_end = content.find(b"}", name_start)
+        if name_end == -1:
+            break
+        name = content[name_start:name_end]
+        to_marker = b"{\\comment tex2rtf/to: " + name + b"}"
+        end = content.find(to_marker, name_end + 1)
+        if end == -1:
+            # not a complete region, look for the next one
+            region_start = content.find(from_marker, region_start + 1)
+            continue
+        # whitespaces are skipped by moving the bounds, so the region is copied only once
+        start = name_end + 1
+        region_end = end + len(to_marker)
+        while start < end and content[start] in WHITESPACES:
+            start += 1
+        while end > start and content[end - 1] in WHITESPACES:
+            end -= 1
+        yield name.decode(), content[start:end]
+        region_start = content.find(from_marker, region_end)
+
+
+def apply_edits(content, edits):
+    """
+    Applies a list of `(position, inserted, deleted_length)` edits, whose positions refer
+    to the original `content`, copying the content only once
+    """
+    output = []
+    copied = 0
+    for position, inserted, deleted_length in sorted(edits, key=lambda edit: edit[0]):
+        output.append(content[copied:position])
+        output.append(inserted)
+        copied = position + deleted_length
+    output.append(content[copied:])
+    return b"".join(output)
 
 
 def fix_footnotes(rtf_content, footnote_size):
     """Looks for `\\footnote` and removes the ending `\\par` and sets font size for the footnote (in half points)"""
-    footnote_size = int(footnote_size * 2)
+    font_size = f"\\fs{int(footnote_size * 2)}".encode()
+    # footnotes are only scanned here, the edits are applied all together at the end
+    edits = []
     # for each footnote
     # find next match
     start_match_search = 0
     while True:
-        match = FOOTNOTE_PATTERN.search(rtf_content, start_match_search)
-        if match is None:
+        start = rtf_content.find(b"\\footnote", start_match_search)
+        if start == -1:
             break
         # find the next `\\chftn` and insert a `\\fsxx` before it
         # this is for the footnote number
-        start = match.start()
-        end = rtf_content.find("\\chftn", start)
-        if end == -1:
+        number_start = rtf_content.find(b"\\chftn", start)
+        if number_start == -1:
             print(
                 "Warning: Could not find `\\chftn` after `\\footnote`; this may means the footnote was malformed."
             )
-        rtf_content = rtf_content[:end] + f"\\fs{footnote_size}" + rtf_content[end:]
+            break
         # now look for the first `{` after the `\\chftn` and insert another `\\fsxx`
         # after the `\\pard` after that
         # this is for the footnote text
-        start = end
-        footnote_start = rtf_content.find("{", start)
-        end = rtf_content.find("\\pard", footnote_start + 1) + 5
-        rtf_content = rtf_content[:end] + f"\\fs{footnote_size}" + rtf_content[end:]
-
-        # loop char by char until we find the closing `}`
-        open_braces = 1
-        close_braces = 0
-        for i in range(end, len(rtf_content)):
-            if rtf_content[i] == "{":
-                open_braces += 1
-            elif rtf_content[i] == "}":
-                close_braces += 1
-            if open_braces == close_braces:
-                break
+        footnote_start = rtf_content.find(b"{", number_start)
+        pard_start = rtf_content.find(b"\\pard", footnote_start + 1)
+        if footnote_start == -1 or pard_start == -1:
+            print(
+                "Warning: Could not find `\\pard` after `\\footnote`; this may means the footnote was malformed."
+            )
+            break
+        text_start = pard_start + 5
+        edits.append((number_start, font_size, 0))
+        edits.append((text_start, font_size, 0))
+
+        # jump from brace to brace until we find the closing `}`
+        depth = 1
+        next_open = rtf_content.find(b"{", text_start)
+        i = rtf_content.find(b"}", text_start)
+        while i != -1:
+            if next_open != -1 and next_open < i:
+                depth += 1
+                next_open = rtf_content.find(b"{", next_open + 1)
+            else:
+                depth -= 1
+                if depth == 0:
+                    break
+                i = rtf_content.find(b"}", i + 1)
+        if i == -1:
+            print(
+                "Warning: Could not find the closing `}` of a `\\footnote`; this may means the footnote was malformed."
+            )
+            break
         # now we are at the closing `}`
-        # remove the `\\par` before it
-        start = rtf_content.rfind("\\par", start, i)
-        rtf_content = rtf_content[:start] + rtf_content[start + 4 :]
-        start_match_search = i - 4
-
-    return rtf_content
+        # remove the `\\par` right before it
+        if i - 4 >= text_start and rtf_content[i - 4 : i] == b"\\par":
+            edits.append((i - 4, b"", 4))
+        start_match_search = i
+
+    return apply_edits(rtf_content, edits)
+
+
+async def extract_region(file_name, rtf_content, config, output_dir):
+    # the RTF region is piped to pandoc, so no temporary file is needed
+    await run_pandoc(
+        "-",
+        config["extract_filetype"],
+        "rtf",
+        config.get("citation_style"),
+        config.get("resource_paths"),
+        config["suppress_bibliography"],
+        input=rtf_content,
+        cache_dir=config.get("cache_dir"),
+        out_path=output_dir / file_name,
+    )
 
 
-def extraction(args, config, output_dir) -> None:
+async def extraction(args, config, output_dir) -> None:
     file_path = args.extract[0]
-    regions_to_extract = extract_rtf_content(file_path)
-    for file_name, rtf_content in regions_to_extract:
-        out_file = output_dir / file_name
-        out_file_rtf = out_file.with_suffix(".rtf")
-        with open(out_file_rtf, "w") as file:
-            file.write(rtf_content)
-        input_content = convert(out_file_rtf, config["extract_filetype"])
-        with open(out_file, "w") as file:
-            file.write(input_content)
-        out_file_rtf.unlink()
-
-
-def concat_tex_files(file_paths):
-    """Concatenate tex files together while inserting markers for each file that will persist through the RTF conversion"""
-    content = ""
+    regions_to_extract = {}
+    for file_name, rtf_content in extract_rtf_content(file_path):
+        # two pandoc processes writing the same file would mix their outputs
+        if file_name in regions_to_extract:
+            print(
+                f"Warning: Found more than one region for {file_name}; only the last one is extracted"
+            )
+        regions_to_extract[file_name] = rtf_content
+    # regions are independent, so they are converted concurrently
+    await gather_limited(
+        extract_region(file_name, rtf_content, config, output_dir)
+        for file_name, rtf_content in regions_to_extract.items()
+    )
+
+
+MARKER = "RTF2COMPILE - MARKER LINE - "
+# matches the full line containing a marker and its own ending newline; the newline
+# before the line is not matched, so adjacent marker lines are all found
+MARKER_LINE_PATTERN = re.compile(
+    rb"^[^\n]*" + re.escape(MARKER.encode()) + rb"[^\n]*(?:\n|\Z)", re.M
+)
+
+
+def concat_files(file_paths):
+    """Concatenate files together while inserting markers for each file that will persist through the RTF conversion"""
+    content = []
     for file_path in file_paths:
-        with open(file_path, "r") as file:
-            file_content = file.read()
-        content += "\n\nRTF2COMPILE - MARKER LINE - " + str(file_path.name) + "\n\n"
-        content += file_content
-    return content
+        content.append(b"\n\n" + MARKER.encode() + file_path.name.encode() + b"\n\n")
+        content.append(file_path.read_bytes())
+    return b"".join(content)
 
 
 def split_rtf_content(rtf_content, file_paths):
     """
     Split the RTF content into the converted files by looking for markers and removing their full line
-    Returns a list of strings representing the content of each file in order of the file_paths provided
+    Returns a list of memoryviews on the content of each file in order of the file_paths provided
     """
-    split_content = rtf_content.split("\n")
+    # the files are views on `rtf_content`, so it is not copied; anything before the
+    # first marker is not part of any file
+    rtf_view = memoryview(rtf_content)
+    marker_spans = [match.span() for match in MARKER_LINE_PATTERN.finditer(rtf_content)]
     file_contents = []
-    current_file = []
-    for i, line in enumerate(split_content):
-        if "RTF2COMPILE - MARKER LINE - " in line:
-            if i > 0:
-                file_contents.append("\n".join(current_file))
-            current_file = []
-        else:
-            current_file.append(line)
-    if len(current_file) > 0:
-        file_contents.append("\n".join(current_file))
+    for (_, marker_end), (next_marker_start, _) in zip(
+        marker_spans, marker_spans[1:] + [(len(rtf_content), None)]
+    ):
+        # the newline ending the last line of a file belongs to the next marker line
+        if next_marker_start < len(rtf_content) and next_marker_start > marker_end:
+            next_marker_start -= 1
+        file_contents.append(rtf_view[marker_end:next_marker_start])
 
     if len(file_contents) != len(file_paths):
         print(
@@ -200,63 +492,101 @@ def split_rtf_content(rtf_content, file_paths):
     return file_contents
 
 
-def compile(config, input_dir, official_template_path, output_dir):
-    with open(config["official_template"], "r") as file:
-        official_template = file.read()
-
-    input_files = list(input_dir.glob("*"))
-    validate_files(input_files)
-    sorted_files = sort_files(input_files)
-
-    # concatenating is needed to keep referencings numbers consistent, because pandoc
-    # will put text because other languages don't support labeling/referencing and use
-    # raw text
-    tex_content = concat_tex_files(sorted_files)
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".tex") as file:
-        file.write(tex_content.encode())
-        file.flush()
-        tex_path = Path(file.name)
-        print("Converting to RTF")
-        rtf_content = convert(
-            tex_path,
-            "rtf",
-            config.get("citation_style"),
-            config.get("resource_paths"),
-            config["suppress_bibliography"],
-            config.get("footnote_size"),
-        )
+async def convert_files(config, sorted_files):
+    """Converts the input files to RTF; returns a list of bytes in the same order of `sorted_files`"""
+    convert_options = (
+        config.get("citation_style"),
+        config.get("resource_paths"),
+        config["suppress_bibliography"],
+        config.get("footnote_size", 10),
+        config.get("cache_dir"),
+    )
+    input_formats = {INPUT_FORMATS.get(file_path.suffix) for file_path in sorted_files}
+    if config.get("concatenate", True) and sorted_files:
+        if input_formats == {"latex"}:
+            # concatenating is needed to keep referencings numbers consistent, because
+            # pandoc will put text because other languages don't support
+            # labeling/referencing and use raw text
+            content = concat_files(sorted_files)
+            print("Converting to RTF")
+            rtf_content = await convert_latex(content, "rtf", *convert_options)
+            return split_rtf_content(rtf_content, sorted_files)
+        # concatenated Markdown files would be parsed as a single document, so footnote
+        # and link labels reused across files would collide; they are always converted
+        # one by one, which is only worth a warning when LaTeX files lose concatenation
+        if "latex" in input_formats:
+            print(
+                "Warning: Input files are not all LaTeX, so they cannot be concatenated; converting them one by one"
+            )
 
-    rtf_contents = split_rtf_content(rtf_content, sorted_files)
+    # each file is converted on its own, so pandoc processes can run in parallel
+    print("Converting to RTF")
+    return await gather_limited(
+        convert(file_path, "rtf", *convert_options) for file_path in sorted_files
+    )
+
+
+async def compile(config, input_dir, official_template_path, output_dir):
+    sorted_files = sorted_files_in(input_dir)
+    validate_files(sorted_files)
 
-    for i, file_path in enumerate(sorted_files):
-        occurrence = find_string(official_template, config["string"])
-        if occurrence is None:
+    output_rtf_path = output_dir / official_template_path.name
+    # the output is written next to its final path and moved there only once the
+    # template is closed, in case the output overwrites the template itself
+    partial_rtf_path = output_rtf_path.with_name(output_rtf_path.name + ".partial")
+    with map_file(official_template_path) as official_template:
+        # the template is searched while pandoc is running
+        rtf_contents, occurrences = await asyncio.gather(
+            convert_files(config, sorted_files),
+            asyncio.to_thread(
+                find_strings, official_template, config["string"].encode()
+            ),
+        )
+        if len(rtf_contents) != len(sorted_files):
+            raise RuntimeError(
+                f"Found {len(rtf_contents)} converted files in the output of pandoc, but {len(sorted_files)} files were given"
+            )
+        if len(occurrences) < len(sorted_files):
             raise RuntimeError(
                 f'Could not find string `{config["string"]}` in {config["official_template"]}'
             )
-        rtf_content = prepend_append_rtf(rtf_contents[i], file_path.name)
-        official_template = (
-            official_template[: occurrence[0]]
-            + rtf_content
-            + official_template[occurrence[1] :]
-        )
 
-    output_rtf_path = output_dir / official_template_path.name
-    with open(output_rtf_path, "w") as file:
-        file.write(official_template)
+        # the template is copied to the output straight from the memory map, with the
+        # converted files written in place of the occurrences
+        with open(partial_rtf_path, "wb") as file, memoryview(
+            official_template
+        ) as template_view:
+            copied = 0
+            for file_path, rtf_content, occurrence in zip(
+                sorted_files, rtf_contents, occurrences
+            ):
+                # the markers are written around the content, without copying it
+                prepend, append = rtf_markers(file_path.name)
+                file.write(template_view[copied : occurrence[0]])
+                file.write(prepend)
+                file.write(rtf_content)
+                file.write(append)
+                copied = occurrence[1]
+            file.write(template_view[copied:])
+    os.replace(partial_rtf_path, output_rtf_path)
 
     compile_command = config.get("pdf_compile", None)
     if compile_command is not None:
         # convert to pdf
-        compile_command = compile_command.replace("%f", f'"{output_rtf_path}"')
         compile_command = compile_command.replace(
-            "%o", f'"{output_rtf_path.with_suffix(".pdf")}"'
+            "%f", shlex.quote(str(output_rtf_path))
+        )
+        compile_command = compile_command.replace(
+            "%o", shlex.quote(str(output_rtf_path.with_suffix(".pdf")))
         )
 
-        subprocess.run(compile_command.split(" "), shell=True)
+        command = shlex.split(compile_command)
+        process = await asyncio.create_subprocess_exec(*command)
+        if await process.wait() != 0:
+            raise subprocess.CalledProcessError(process.returncode, command)
 
 
-def main():
+async def main():
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "-e", "--extract", nargs=1, metavar="file", help="RTF file to extract from"
@@ -270,12 +600,15 @@ def main():
     official_template_path = Path(config["official_template"])
 
     check_pandoc()
+    if config.get("cache_dir") is not None:
+        # the pandoc version is part of the cache keys
+        pandoc_version()
 
     if args.extract:
-        extraction(args, config, output_dir)
+        await extraction(args, config, output_dir)
     else:
-        compile(config, input_dir, official_template_path, output_dir)
+        await compile(config, input_dir, official_template_path, output_dir)
 
 
 if __name__ == "__main__":
-    main()
+    asyncio.run(main())